@@ -11,10 +11,19 @@ import cv2
 import numpy as np
 import imageio
 import os
+import queue
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional, Tuple
 
+# Make sure OpenCV dispatches to its SSE/AVX kernels for resizing
+cv2.setUseOptimized(True)
+
 
 class VideoToGifConverter:
     """Handles video to GIF conversion with various optimization options."""
@@ -31,6 +40,10 @@ class VideoToGifConverter:
         self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
         self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
         self.duration = self.total_frames / self.fps
+        
+        # Detect decoding capabilities once up front
+        self.pyav = self._check_pyav_available()
+        self.ffmpeg = self._find_ffmpeg()
     
     def __del__(self):
         if hasattr(self, 'cap'):
@@ -48,7 +61,8 @@ class VideoToGifConverter:
     def create_gif(self, output_path: str, duration: float = 5.0,
                    width: Optional[int] = None, fps: int = 10,
                    start_time: float = 0, stop_time: Optional[float] = None,
-                   optimize: bool = True) -> str:
+                   optimize: bool = True, dedupe: bool = True,
+                   encoder: str = 'pil') -> str:
         """
         Create a GIF from the video with specified parameters.
         
@@ -62,6 +76,11 @@ class VideoToGifConverter:
         if start_time >= stop_time:
             raise ValueError(f"start_time ({start_time}) must be less than stop_time ({stop_time})")
         
+        if encoder not in ('pil', 'ffmpeg'):
+            raise ValueError(f"encoder must be 'pil' or 'ffmpeg', not {encoder!r}")
+        if optimize and encoder == 'ffmpeg' and not self.ffmpeg:
+            raise ValueError("The ffmpeg encoder needs an ffmpeg binary, but none was found")
+        
         effective_duration = stop_time - start_time
         start_frame = int(start_time * self.fps)
         end_frame = int(stop_time * self.fps)
@@ -81,40 +100,433 @@ class VideoToGifConverter:
         output_frames_count = int(duration * fps)
         frame_interval = effective_frames / output_frames_count
         
-        # Collect frames
-        frames = []
-        frame_indices = [start_frame + min(int(i * frame_interval), effective_frames - 1) 
-                        for i in range(output_frames_count)]
+        # Collect frames, letting PyAV or ffmpeg sample and scale in one pass
+        # when available and falling back to decoding with OpenCV
+        frames = None
+        if self.pyav:
+            try:
+                frames = self._decode_with_pyav(start_time, stop_time, output_frames_count,
+                                                new_width, new_height)
+            except Exception as e:
+                click.echo(f"\nWarning: PyAV could not decode the video ({e}), "
+                           f"falling back", err=True)
         
-        with click.progressbar(frame_indices, label='Processing frames') as indices:
-            for frame_idx in indices:
-                self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
-                ret, frame = self.cap.read()
-                
-                if not ret:
-                    continue
-                
-                # Convert BGR to RGB
-                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                
-                # Resize if needed
-                if scale_factor != 1.0:
-                    frame_rgb = cv2.resize(frame_rgb, (new_width, new_height), 
-                                         interpolation=cv2.INTER_AREA)
-                
-                frames.append(frame_rgb)
+        if frames is None and self.ffmpeg:
+            frames = self._decode_with_ffmpeg(start_time, stop_time, output_frames_count,
+                                              new_width, new_height)
+        elif frames is None:
+            offsets = (np.arange(output_frames_count) * frame_interval).astype(np.int64)
+            frame_indices = start_frame + np.minimum(offsets, effective_frames - 1)
+            frames = self._decode_with_opencv(frame_indices, start_frame, end_frame,
+                                              new_width, new_height)
+        
+        if len(frames) == 0:
+            raise ValueError(f"No frames could be decoded from {self.video_path}")
+        if len(frames) < output_frames_count:
+            click.echo(f"Warning: only {len(frames)} of {output_frames_count} frames "
+                       f"could be decoded", err=True)
         
         # Create GIF
         click.echo("Creating GIF...")
         frame_duration = 1.0 / fps
         
-        if optimize and self._check_pil_available():
-            self._save_optimized_gif(frames, output_path, frame_duration)
+        if dedupe:
+            frames, durations = self._dedupe_frames(frames, frame_duration)
         else:
-            imageio.mimsave(output_path, frames, duration=frame_duration, loop=0)
+            durations = [frame_duration] * len(frames)
+        
+        if optimize and encoder == 'ffmpeg':
+            self._save_ffmpeg_gif(frames, output_path, durations, frame_duration)
+        elif optimize and self._check_pil_available():
+            self._save_optimized_gif(frames, output_path, durations)
+        else:
+            # Frames are stored in OpenCV's BGR order; imageio's Pillow writer
+            # uses milliseconds
+            imageio.mimsave(output_path, frames[..., ::-1],
+                            duration=[d * 1000 for d in durations], loop=0)
         
         return output_path
     
+    def _decode_with_opencv(self, frame_indices: np.ndarray, start_frame: int, end_frame: int,
+                            new_width: int, new_height: int) -> np.ndarray:
+        """Decode the sampled frames with OpenCV into an (N, H, W, 3) BGR array."""
+        # Sampling may hit the same source frame more than once. Indices are
+        # sorted, so each source frame fills a contiguous run of output slots.
+        targets = np.unique(frame_indices)
+        starts = np.searchsorted(frame_indices, targets, side='left').tolist()
+        stops = np.searchsorted(frame_indices, targets, side='right').tolist()
+        targets = targets.tolist()
+        
+        frames = np.empty((len(frame_indices), new_height, new_width, 3), dtype=np.uint8)
+        filled = np.zeros(len(frame_indices), dtype=bool)
+        
+        # Resizing releases the GIL, so it runs on a pool of workers while
+        # this thread keeps the decoder busy. Frames stay in BGR order; the
+        # channel swap happens once, when PIL unpacks them for encoding.
+        # A single decoder cannot keep more than a few workers busy, and each
+        # one adds full-resolution buffers to the pool below
+        workers = min(os.cpu_count() or 1, 4)
+        work = queue.Queue(maxsize=2 * workers)
+        
+        # Decoded frames are retrieved into a fixed pool of BGR buffers that
+        # the workers hand back once resized, instead of a fresh array per
+        # frame. The pool covers a full queue plus one frame per worker, and
+        # is LIFO so that buffers which are never needed are never touched.
+        free = queue.LifoQueue()
+        for _ in range(3 * workers):
+            free.put(np.empty((self.height, self.width, 3), dtype=np.uint8))
+        
+        # Workers record the first error instead of exiting, so they keep
+        # draining the queue and the decoder never blocks on a dead pool
+        done = threading.Event()
+        errors = []
+        executor = ThreadPoolExecutor(max_workers=workers)
+        for _ in range(workers):
+            executor.submit(self._resize_frames, work, free, frames, filled, done, errors)
+        
+        # Decode sequentially and only retrieve the sampled frames. Seeking
+        # per frame forces the decoder back to the previous keyframe, while
+        # grab() advances without the BGR conversion of skipped frames.
+        k = 0
+        target = targets[0]
+        reported = 0
+        grab, retrieve = self.cap.grab, self.cap.retrieve
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+        
+        try:
+            with click.progressbar(length=len(frame_indices), label='Processing frames') as bar:
+                cur = start_frame
+                while cur < end_frame:
+                    if not grab():
+                        # A damaged packet or the end of the stream. Give up on
+                        # the current target if this was it, then re-seek to the
+                        # next one rather than dropping the rest of the segment.
+                        if cur == target:
+                            k += 1
+                            if k == len(targets):
+                                break
+                            target = targets[k]
+                        cur = target
+                        self.cap.set(cv2.CAP_PROP_POS_FRAMES, cur)
+                        continue
+                    
+                    cur += 1
+                    if cur - 1 != target:
+                        continue
+                    if errors:
+                        break
+                    
+                    ret, frame = retrieve(free.get())
+                    if ret:
+                        work.put((starts[k], stops[k], frame))
+                    else:
+                        free.put(frame)
+                    
+                    # Redraw the progress bar every 10 frames rather than per frame
+                    if stops[k] - reported >= 10:
+                        bar.update(stops[k] - reported)
+                        reported = stops[k]
+                    
+                    k += 1
+                    if k == len(targets):
+                        break
+                    target = targets[k]
+                
+                bar.update(len(frame_indices) - reported)
+        finally:
+            done.set()
+            executor.shutdown(wait=True)
+        
+        if errors:
+            raise errors[0]
+        
+        # Drop slots whose frame could not be read
+        if not filled.all():
+            frames = self._compact_frames(frames, np.flatnonzero(filled))
+        
+        return frames
+    
+    def _decode_with_ffmpeg(self, start_time: float, stop_time: float, frame_count: int,
+                            new_width: int, new_height: int) -> np.ndarray:
+        """Decode, sample and scale frames in a single ffmpeg pass into an (N, H, W, 3) BGR array."""
+        sample_rate = frame_count / (stop_time - start_time)
+        filters = f"fps={sample_rate:.6f}"
+        if (new_width, new_height) != (self.width, self.height):
+            filters += f",scale={new_width}:{new_height}:flags=area"
+        
+        # -hwaccel auto uses a hardware decoder when a device is present and
+        # falls back to software otherwise. -ss/-to before -i seek on the
+        # input using the keyframe index.
+        cmd = [
+            self.ffmpeg, '-nostdin', '-v', 'error', '-threads', '0', '-hwaccel', 'auto',
+            '-ss', str(start_time), '-to', str(stop_time), '-i', self.video_path,
+            '-vf', filters, '-frames:v', str(frame_count),
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1',
+        ]
+        
+        frames = np.empty((frame_count, new_height, new_width, 3), dtype=np.uint8)
+        count = 0
+        
+        # Damaged inputs can make ffmpeg log far more than a pipe buffer holds
+        # while stdout is still being read, so stderr goes to a temporary file
+        with tempfile.TemporaryFile() as log:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=log)
+            with click.progressbar(length=frame_count, label='Processing frames') as bar:
+                while count < frame_count:
+                    out = memoryview(frames[count]).cast('B')
+                    if proc.stdout.readinto(out) != len(out):
+                        break
+                    count += 1
+                    bar.update(1)
+            
+            proc.stdout.close()
+            returncode = proc.wait()
+            
+            log.seek(max(log.tell() - 2048, 0))
+            error = log.read().decode(errors='replace').strip()
+        
+        if returncode != 0 and count == 0:
+            raise RuntimeError(f"ffmpeg failed to decode {self.video_path}: {error}")
+        
+        return frames[:count]
+    
+    def _decode_with_pyav(self, start_time: float, stop_time: float, frame_count: int,
+                          new_width: int, new_height: int) -> np.ndarray:
+        """Decode, sample and scale frames through a PyAV filter graph into an (N, H, W, 3) BGR array."""
+        import av
+        
+        frames = np.empty((frame_count, new_height, new_width, 3), dtype=np.uint8)
+        count = 0
+        graph = None
+        
+        def build_graph(stream, first):
+            # Phone videos store frames unrotated with a display matrix, while
+            # OpenCV and the ffmpeg CLI report and return the rotated picture
+            rotation = round(first.rotation) % 360
+            filters = [('fps', f"{frame_count / (stop_time - start_time):.6f}")]
+            filters += {90: [('transpose', 'cclock')], 180: [('hflip', ''), ('vflip', '')],
+                        270: [('transpose', 'clock')]}.get(rotation, [])
+            size = (first.height, first.width) if rotation in (90, 270) else (first.width, first.height)
+            if size != (new_width, new_height):
+                filters.append(('scale', f"{new_width}:{new_height}:flags=area"))
+            filters.append(('format', 'bgr24'))
+            
+            # Sampling, rotation, scaling and pixel format conversion all run
+            # inside libavfilter; Python only sees the frames that are kept
+            graph = av.filter.Graph()
+            nodes = [graph.add_buffer(template=stream)]
+            nodes += [graph.add(name, args) for name, args in filters]
+            nodes.append(graph.add('buffersink'))
+            graph.link_nodes(*nodes).configure()
+            return graph
+        
+        def drain(bar):
+            nonlocal count
+            while count < frame_count:
+                try:
+                    frame = graph.vpull()
+                except (av.BlockingIOError, av.EOFError):
+                    return
+                frames[count] = frame.to_ndarray()
+                count += 1
+                bar.update(1)
+        
+        with self._open_with_pyav() as container:
+            stream = container.streams.video[0]
+            stream.thread_type = 'AUTO'
+            
+            def decoded_frames():
+                for packet in container.demux(stream):
+                    try:
+                        yield from packet.decode()
+                    except av.InvalidDataError:
+                        # Skip damaged packets rather than failing the conversion
+                        continue
+            
+            # Seek to the keyframe before start_time and decode forward from there
+            container.seek(int(start_time / stream.time_base), stream=stream)
+            
+            with click.progressbar(length=frame_count, label='Processing frames') as bar:
+                for frame in decoded_frames():
+                    if frame.time < start_time:
+                        continue
+                    if frame.time >= stop_time or count == frame_count:
+                        break
+                    if graph is None:
+                        graph = build_graph(stream, frame)
+                    graph.vpush(frame)
+                    drain(bar)
+                
+                if graph is not None:
+                    graph.vpush(None)
+                    drain(bar)
+        
+        return frames[:count]
+    
+    def _open_with_pyav(self):
+        """Open the video with PyAV, decoding on the first hardware device that can be created."""
+        import av
+        try:
+            from av.codec.hwaccel import HWAccel, hwdevices_available
+        except ImportError:
+            return av.open(self.video_path)
+        
+        # Device types are only what FFmpeg was built with; opening fails
+        # when no such device is present, so try each before software
+        for device_type in hwdevices_available():
+            try:
+                return av.open(self.video_path,
+                               hwaccel=HWAccel(device_type, allow_software_fallback=True))
+            except av.FFmpegError:
+                continue
+        return av.open(self.video_path)
+    
+    def _check_pyav_available(self) -> bool:
+        """Check if PyAV is available for decoding."""
+        try:
+            import av
+            return True
+        except ImportError:
+            return False
+    
+    def _find_ffmpeg(self) -> Optional[str]:
+        """Return the path to an ffmpeg binary, or None if none is available."""
+        try:
+            import imageio_ffmpeg
+            return imageio_ffmpeg.get_ffmpeg_exe()
+        except (ImportError, RuntimeError):
+            return shutil.which('ffmpeg')
+    
+    def _resize_frames(self, work: queue.Queue, free: queue.Queue, frames: np.ndarray,
+                       filled: np.ndarray, done: threading.Event, errors: list):
+        """Resize queued frames into their output slots until done is set and the queue is empty."""
+        new_height, new_width = frames.shape[1:3]
+        resize = (new_width, new_height) != (self.width, self.height)
+        
+        # For downscales of 4x or more, halve with pyrDown first and leave
+        # only the remaining factor of 2-4x to INTER_AREA. Each worker keeps
+        # its own buffer per pyramid level.
+        pyramid = []
+        if resize:
+            ratio = min(self.width / new_width, self.height / new_height)
+            width, height = self.width, self.height
+            for _ in range(int(np.log2(ratio)) - 1):
+                width, height = (width + 1) // 2, (height + 1) // 2
+                pyramid.append(np.empty((height, width, 3), dtype=np.uint8))
+        
+        while True:
+            try:
+                start, stop, frame = work.get(timeout=0.1)
+            except queue.Empty:
+                if done.is_set():
+                    return
+                continue
+            
+            try:
+                # Once any worker has failed, just hand buffers back
+                if errors:
+                    continue
+                
+                out = frames[start]
+                if resize:
+                    src = frame
+                    for level in pyramid:
+                        src = cv2.pyrDown(src, dst=level)
+                    cv2.resize(src, (new_width, new_height), dst=out,
+                               interpolation=cv2.INTER_AREA)
+                else:
+                    np.copyto(out, frame)
+                
+                frames[start + 1:stop] = out
+                filled[start:stop] = True
+            except Exception as e:
+                errors.append(e)
+            finally:
+                free.put(frame)
+    
+    def _dedupe_frames(self, frames: np.ndarray, frame_duration: float,
+                       threshold: int = 2, tolerance: int = 8) -> Tuple[np.ndarray, list]:
+        """
+        Drop frames that repeat the last kept frame, extending its duration instead.
+        
+        Frames are compared by a 64-bit difference hash first, and matches are
+        confirmed against the pixels so small changes such as typed text survive.
+        
+        Returns the kept frames and their durations in seconds.
+        """
+        if len(frames) < 2:
+            return frames, [frame_duration] * len(frames)
+        
+        hashes = np.empty((len(frames), 8), dtype=np.uint8)
+        for i, frame in enumerate(frames):
+            small = cv2.resize(frame, (9, 8), interpolation=cv2.INTER_AREA)
+            gray = small.mean(axis=-1)
+            hashes[i] = np.packbits(gray[:, 1:] > gray[:, :-1])
+        
+        keep = [0]
+        durations = [frame_duration]
+        for i in range(1, len(frames)):
+            last = keep[-1]
+            distance = np.unpackbits(hashes[i] ^ hashes[last]).sum()
+            if (distance < threshold
+                    and cv2.norm(frames[i], frames[last], cv2.NORM_INF) <= tolerance):
+                durations[-1] += frame_duration
+            else:
+                keep.append(i)
+                durations.append(frame_duration)
+        
+        if len(keep) < len(frames):
+            frames = self._compact_frames(frames, keep)
+        
+        return frames, durations
+    
+    def _save_ffmpeg_gif(self, frames: np.ndarray, output_path: str, durations: list,
+                         frame_duration: float):
+        """Save GIF with ffmpeg's palettegen/paletteuse filters and gif encoder."""
+        height, width = frames.shape[1:3]
+        
+        # A raw frame pipe has a constant frame rate, so merged frames are
+        # written once per frame period and mpdecimate drops the exact
+        # repeats again. The GIF muxer turns the resulting timestamp gaps
+        # into frame delays, and -final_delay covers the last frame.
+        filters = ("mpdecimate=hi=0:max=0,split[s0][s1];[s0]palettegen=max_colors=256[p];"
+                   "[s1][p]paletteuse=dither=bayer:bayer_scale=5")
+        cmd = [
+            self.ffmpeg, '-nostdin', '-v', 'error', '-y',
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f"{width}x{height}",
+            '-r', f"{1 / frame_duration:g}", '-i', 'pipe:0',
+            '-vf', filters, '-fps_mode', 'vfr', '-loop', '0',
+            '-final_delay', str(round(durations[-1] * 100)), output_path,
+        ]
+        
+        with tempfile.TemporaryFile() as log:
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=log)
+            try:
+                for frame, duration in zip(frames, durations):
+                    data = memoryview(np.ascontiguousarray(frame)).cast('B')
+                    for _ in range(round(duration / frame_duration)):
+                        proc.stdin.write(data)
+            except BrokenPipeError:
+                pass
+            finally:
+                proc.stdin.close()
+            returncode = proc.wait()
+            
+            log.seek(max(log.tell() - 2048, 0))
+            error = log.read().decode(errors='replace').strip()
+        
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg failed to encode {output_path}: {error}")
+    
+    def _compact_frames(self, frames: np.ndarray, keep) -> np.ndarray:
+        """Move the kept frames to the front of the array in place and return a view of them."""
+        # Indices are increasing, so each frame moves down onto a slot that
+        # has already been read; this avoids a second full-size frame array
+        for dst, src in enumerate(keep):
+            if dst != src:
+                frames[dst] = frames[src]
+        return frames[:len(keep)]
+    
     def _check_pil_available(self) -> bool:
         """Check if PIL is available for optimization."""
         try:
@@ -123,19 +535,52 @@ class VideoToGifConverter:
         except ImportError:
             return False
     
-    def _save_optimized_gif(self, frames: list, output_path: str, frame_duration: float):
+    def _save_optimized_gif(self, frames: np.ndarray, output_path: str, durations: list):
         """Save GIF with PIL optimization."""
         from PIL import Image
         
-        # Convert numpy arrays to PIL Images
-        pil_frames = [Image.fromarray(frame) for frame in frames]
+        # Build a single 256-colour palette from every 4th pixel of 16 evenly
+        # spaced frames and map all frames onto it, rather than letting each
+        # frame pick its own. This keeps the median cut cost fixed however
+        # long the GIF is, and a shared palette gives the LZW encoder longer runs.
+        picks = np.unique(np.linspace(0, len(frames) - 1, 16).astype(int))
+        sample = frames[picks, ::4, ::4].reshape(1, -1, 3)
+        palette = Image.frombuffer('RGB', sample.shape[1::-1], sample, 'raw', 'BGR', 0, 1)
+        palette = palette.quantize(colors=256, method=Image.Quantize.MEDIANCUT)
+        
+        # Quantize every frame to palette indices in an (N, H, W) array. Each
+        # BGR frame is unpacked straight into PIL's RGB layout, so the channel
+        # swap happens once in PIL's C decoder, and quantizing releases the
+        # GIL so frames are spread over a pool of workers.
+        height, width = frames.shape[1:3]
+        indices = np.empty(frames.shape[:3], dtype=np.uint8)
+        
+        def quantize(i):
+            image = Image.frombuffer('RGB', (width, height), frames[i], 'raw', 'BGR', 0, 1)
+            image = image.quantize(palette=palette, dither=Image.Dither.FLOYDSTEINBERG)
+            indices[i] = np.asarray(image)
+        
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+            list(executor.map(quantize, range(len(frames))))
+        
+        # The encoder then only handles one byte per pixel. Indexed frames
+        # wrap rows of the array without copying and share the palette.
+        colours = palette.getpalette()
+        
+        def indexed_frames():
+            for index in indices:
+                image = Image.frombuffer('P', (width, height), index, 'raw', 'P', 0, 1)
+                image.putpalette(colours)
+                yield image
+        
+        pil_frames = indexed_frames()
         
         # Save with optimization
-        pil_frames[0].save(
+        next(pil_frames).save(
             output_path,
             save_all=True,
-            append_images=pil_frames[1:],
-            duration=frame_duration * 1000,  # PIL uses milliseconds
+            append_images=pil_frames,
+            duration=[d * 1000 for d in durations],  # PIL uses milliseconds
             loop=0,
             optimize=True,
             quality=85
@@ -175,9 +620,12 @@ def validate_video_file(ctx, param, value):
 @click.option('--start', 'start_time', default=0.0, help='Start time in seconds')
 @click.option('--stop', 'stop_time', type=float, help='Stop time in seconds')
 @click.option('--no-optimize', is_flag=True, help='Disable GIF optimization')
+@click.option('--no-dedupe', is_flag=True, help='Keep repeated frames instead of merging them')
+@click.option('--encoder', type=click.Choice(['pil', 'ffmpeg']), default='pil',
+              help='Encoder for optimized GIFs')
 @click.option('--info', is_flag=True, help='Show video info and exit')
 def create_gif(video_file, output_file, duration, width, fps, start_time, 
-               stop_time, no_optimize, info):
+               stop_time, no_optimize, no_dedupe, encoder, info):
     """
     Convert video to email-friendly GIF.
     
@@ -239,7 +687,9 @@ def create_gif(video_file, output_file, duration, width, fps, start_time,
             fps=fps,
             start_time=start_time,
             stop_time=stop_time,
-            optimize=not no_optimize
+            optimize=not no_optimize,
+            dedupe=not no_dedupe,
+            encoder=encoder
         )
         
         # Report results